@@ -0,0 +1,92 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+pytest.importorskip("pandas")
+pytest.importorskip("datajoint")  # imported by the workflow package
+
+from workflow.utils import demodulation
+
+
+def _rms(x):
+    return np.sqrt(np.mean(np.square(x), axis=-1))
+
+
+def test_bandpass_signal():
+    fs, center = 6000, 500
+    t = np.arange(20000) / fs
+    in_band = np.sin(2 * np.pi * center * t)
+    out_band = np.sin(2 * np.pi * 1500 * t)
+    # ignore the filter transients at both ends
+    middle = slice(2000, -2000)
+
+    for dtype in (np.float64, np.float32):
+        y = demodulation.bandpass_signal(in_band.astype(dtype), center_fs=center, fs=fs)
+        assert y.shape == in_band.shape
+        np.testing.assert_allclose(_rms(y[middle]) / _rms(in_band[middle]), 1, atol=0.05)
+
+        y = demodulation.bandpass_signal(out_band.astype(dtype), center_fs=center, fs=fs)
+        assert _rms(y[middle]) < 0.01 * _rms(out_band[middle])
+
+
+def test_bandpass_signal_2d():
+    x = np.random.default_rng(0).standard_normal((3, 20000))
+    y = demodulation.bandpass_signal(x, center_fs=500, fs=6000, axis=-1)
+    for row, y_row in zip(x, y):
+        np.testing.assert_allclose(
+            demodulation.bandpass_signal(row, center_fs=500, fs=6000), y_row, atol=1e-12
+        )
+
+
+def test_demodulate():
+    fs, carrier = 6000, 500
+    t = np.arange(int(5 * fs)) / fs
+    x = np.sin(2 * np.pi * carrier * t)
+    ref_x = np.sin(2 * np.pi * carrier * t)
+    ref_y = np.cos(2 * np.pi * carrier * t)
+    _, _, r, downsample_fs = demodulation.demodulate(
+        x, carrier, ref_x=ref_x, ref_y=ref_y, fs=fs, downsample_fs=500
+    )
+    # the first and last demod_tau (0.5 s) are set to NaN
+    edge = int(0.5 * downsample_fs)
+    assert np.all(np.isfinite(r[edge:-edge]))
+
+
+def test_carrier_spectrogram_matches_scipy():
+    from scipy import signal
+    from scipy.signal.windows import hamming
+
+    fs, nperseg, noverlap = 2000, 216, 108
+    window = hamming(nperseg, "periodic")
+    rng = np.random.default_rng(0)
+    t = np.arange(20000) / fs
+    # DC and its neighbour bin, two carriers, and the bins next to/at Nyquist
+    carriers = [0, 5, 200, 350, 995, 1000]
+    x = np.stack(
+        [np.sin(2 * np.pi * c * t) + 0.5 + rng.standard_normal(t.size) for c in carriers]
+    )
+
+    power, t_seg = demodulation.carrier_spectrogram(
+        x, carriers, fs, window, nperseg, noverlap
+    )
+
+    for row, carrier in enumerate(carriers):
+        f, t_ref, sxx = signal.spectrogram(
+            x[row], fs, window=window, nperseg=nperseg, noverlap=noverlap
+        )
+        np.testing.assert_allclose(t_seg, t_ref)
+        expected = sxx[np.argmin(np.abs(f - carrier))]
+        np.testing.assert_allclose(power[row], expected, rtol=1e-6, atol=1e-12)
+
+
+@pytest.mark.parametrize("wn", [200, 201])
+def test_rolling_z_matches_pandas(monkeypatch, wn):
+    pytest.importorskip("numba")
+    x = np.random.default_rng(0).normal(5, 2, (3, 5000))
+
+    numba_1d, numba_2d = demodulation.rolling_z(x[0], wn), demodulation.rolling_z(x, wn)
+    monkeypatch.setattr(demodulation, "njit", None)  # force the pandas path
+    pandas_1d, pandas_2d = demodulation.rolling_z(x[0], wn), demodulation.rolling_z(x, wn)
+
+    np.testing.assert_allclose(numba_1d, pandas_1d, atol=1e-8)
+    np.testing.assert_allclose(numba_2d, pandas_2d, atol=1e-8)
@@ -0,0 +1,78 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+pytest.importorskip("datajoint")  # imported by the workflow package
+
+from workflow.utils import photometry_preprocessing as pp
+
+
+def _groupby_downsample(df, factor, photo_columns):
+    """The groupby("bin_ids").agg(col_fcns) downsampling it replaces"""
+    binned = df.assign(bin_ids=np.arange(len(df)) // factor)
+    col_fcns = {col: "max" for col in df.columns if col not in photo_columns}
+    col_fcns.update({col: "mean" for col in photo_columns})
+    return binned.groupby("bin_ids").agg(col_fcns).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("use_numba", [True, False])
+def test_downsample_task_states(monkeypatch, use_numba):
+    if use_numba:
+        if pp.downsample_bins is None:
+            pytest.skip("numba is not installed")
+    else:
+        monkeypatch.setattr(pp, "downsample_bins", None)
+
+    rng = np.random.default_rng(0)
+    n_samples = 10  # two full bins of 4 and a trailing partial bin of 2
+    df = pd.DataFrame(
+        {
+            "nTrial": np.repeat([1, 2, 3], [3, 4, 3]),
+            "detrend_grnR": rng.standard_normal(n_samples),
+            "ENL": rng.integers(0, 2, n_samples),
+            "session_clock": np.arange(n_samples) * 0.005,
+            "z_grnR": rng.standard_normal(n_samples),
+        }
+    )
+    df.loc[3, "detrend_grnR"] = np.nan
+    photo_columns = ["detrend_grnR", "z_grnR"]
+
+    downsampled = pp.downsample_task_states(df, 4, photo_columns)
+
+    expected = _groupby_downsample(df, 4, photo_columns)
+    # photometry columns come last, FiberPhotometrySynced relies on it
+    assert list(downsampled.columns[-2:]) == photo_columns
+    pd.testing.assert_frame_equal(downsampled, expected)
+
+
+def _penalty_session(penalty_trials):
+    """Three trials of 4 samples, ENLP flagged on the last sample of penalty_trials"""
+    df = pd.DataFrame(
+        {
+            "nTrial": np.repeat([1, 2, 3], 4),
+            "ENL": np.ones(12, dtype=int),
+            "nENL": np.tile([0, 1, 1, 2], 3),
+            "ENLP": np.zeros(12, dtype=int),
+        }
+    )
+    for trial in penalty_trials:
+        df.loc[(df.nTrial == trial).to_numpy().nonzero()[0][-1], "ENLP"] = 1
+    behavior_df = pd.DataFrame({"nTrial": [1, 2, 3], "n_ENL": [2, 2, 1]})
+    return df, behavior_df
+
+
+# per trial, ENL samples before the n_ENL-th ENL of a penalty trial are pre-penalty
+PRE_PENALTY = {1: [1, 1, 1, 0], 2: [1, 1, 1, 0], 3: [1, 0, 0, 0]}
+
+
+@pytest.mark.parametrize("penalty_trials", [[], [2], [1, 3], [1, 2, 3]])
+def test_split_penalty_states(penalty_trials):
+    df, behavior_df = _penalty_session(penalty_trials)
+
+    pp.split_penalty_states(df, behavior_df, penalties=("ENLP",))
+
+    expected_state = np.concatenate(
+        [PRE_PENALTY[t] if t in penalty_trials else [0] * 4 for t in (1, 2, 3)]
+    )
+    np.testing.assert_array_equal(df["state_ENLP"], expected_state)
+    np.testing.assert_array_equal(df["ENL"], 1 - expected_state)
@@ -3,14 +3,11 @@ import datajoint as dj
 import pandas as pd
 import numpy as np
 import warnings
+import fnmatch
 from pathlib import Path
 import tomli
-import tdt
-import pymatreader
+import h5py
 import scipy.io as spio
-from scipy import signal
-from scipy.fft import fft, ifft, rfft
-from copy import deepcopy
 
 from element_interface.utils import find_full_path
 from workflow import db_prefix
@@ -23,6 +20,17 @@ from workflow.utils import demodulation
 logger = dj.logger
 schema = dj.schema(db_prefix + "photometry")
 
+# Files making up a TDT block (tank events, headers, notes and index)
+TDT_BLOCK_SUFFIXES = {".tev", ".tsq", ".tbk", ".tdx", ".tin", ".tnt"}
+# Sections of the meta_info.toml read by FiberPhotometry.make, as dotted key paths
+FIBER_META_REQUIRED_KEYS = [
+    "Processing_Parameters",
+    "Signal_Indices.right",
+    "Signal_Indices.left",
+    "Fiber.implantation.right",
+    "Fiber.implantation.left",
+]
+
 
 @schema
 class SensorProtein(dj.Lookup):
@@ -92,7 +100,7 @@ class FiberPhotometry(dj.Imported):
         -> [nullable] ExcitationWavelength
         -> [nullable] CarrierFrequency
         demod_sample_rate   : float       # sample rate of the demodulated data (in Hz) 
-        trace               : longblob    # demodulated photometry traces
+        trace               : longblob    # demodulated photometry traces (float32)
         """
 
     def make(self, key):
@@ -103,73 +111,100 @@ class FiberPhotometry(dj.Imported):
         session_full_dir: Path = find_full_path(get_raw_root_data_dir(), session_dir)
         photometry_dir = session_full_dir / "Photometry"
 
+        # List the photometry folder once and sort its files by type in a single pass
+        toml_files, data_mat_files, timeseries_mat_files, tdt_files = [], [], [], []
+        for f in sorted(photometry_dir.iterdir()):
+            if f.suffix == ".toml":
+                toml_files.append(f)
+            elif fnmatch.fnmatchcase(f.name, "data*.mat"):
+                data_mat_files.append(f)
+            elif fnmatch.fnmatchcase(f.name, "*timeseries*.mat"):
+                timeseries_mat_files.append(f)
+            elif f.suffix.lower() in TDT_BLOCK_SUFFIXES:
+                tdt_files.append(f)
+
         # Read from the meta_info.toml in the photometry folder if exists
-        meta_info_file = list(photometry_dir.glob("*.toml"))[0]
-        meta_info = {}
-        try:
-            with open(meta_info_file, "rb") as f:
-                meta_info = tomli.load(f)
-        except FileNotFoundError:
-            logger.info("meta info is missing")
+        meta_info_file = toml_files[0]
+        meta_info = _load_meta_info(meta_info_file, FIBER_META_REQUIRED_KEYS)
         light_source_name = meta_info.get("Fiber", {}).get("light_source", "")
 
         # Scan directory for data format
         # If there is a .tdt file, then it is a tdt data and enter tdt_data mode
         # If there is a data*.mat file, then it is a matlab data and enter matlab_data mode
         # If there is a timeseries2.mat file, then it is demux matlab data and enter demux_matlab_data mode  
-        if len(list(photometry_dir.glob("data*.mat"))) > 0:
+        # Only the needed MATLAB variable is loaded, and struct arrays are indexed as
+        # returned by loadmat rather than converted cell by cell into dicts
+        if data_mat_files:
             data_format = "matlab_data"
-            matlab_data: dict = spio.loadmat(
-            next(photometry_dir.glob("data*.mat")), simplify_cells=True)
-            matlab_data=matlab_data["data"]
-        elif len(list(photometry_dir.glob("*timeseries*.mat"))) > 0:
+            # The traces are looked up by name, configurable in the meta file
+            variable_name = meta_info.get("Processing_Parameters", {}).get(
+                "matlab_variable", "data"
+            )
+            data_struct = spio.loadmat(
+                data_mat_files[0], variable_names=[variable_name], squeeze_me=True
+            )[variable_name]
+        elif timeseries_mat_files:
             data_format = "demux_matlab_data"
+            photometry_file = timeseries_mat_files[0]
             try:
-                demux_matlab_data: list[dict] = spio.loadmat(
-                    next(photometry_dir.glob("*timeseries*.mat")), simplify_cells=True
+                data_struct = spio.loadmat(
+                    photometry_file, variable_names=["timeSeries"], squeeze_me=True
                 )["timeSeries"]
             except NotImplementedError:
-                # If scipy throws a NotImplementedError, use pymatreader for MATLAB v7.3 files
+                # If scipy throws a NotImplementedError, this is a MATLAB v7.3 (HDF5) file,
+                # read below once the needed channel indices are known
                 data_format = "demux_matlab_data_mat73"
-                photometry_file = next(photometry_dir.glob("*timeseries*.mat"))
-                data_dict = pymatreader.read_mat(photometry_file)
-                demux_matlab_data = data_dict["timeSeries"]
-        elif len(list(photometry_dir.glob("*.t*"))) > 0:
+        elif tdt_files:
             data_format = "tdt_data"
-            tdt_data: tdt.StructType = tdt.read_block(photometry_dir)      
+            # tdt (and the matplotlib it pulls in) is only imported for TDT sessions
+            import tdt
+
+            # Only the Fi1r (right) and Fi2r (left) streams are used, skip everything else
+            tdt_data: tdt.StructType = tdt.read_block(
+                photometry_dir, evtype=["streams"], store=["Fi1r", "Fi2r"]
+            )
         
         ## Enter into different data format mode
+        processing_parameters = meta_info.get("Processing_Parameters")
+        sampling_Hz = processing_parameters.get("sampling_frequency", None)
+        beh_synch_signal = processing_parameters.get("behavior_offset", 0)
+
+        #Get index of traces
+        trace_indices = meta_info.get("Signal_Indices")
+        right_indices = trace_indices.get("right")
+        left_indices = trace_indices.get("left")
+        # Channel indices ordered as g_right, r_right, g_left, r_left
+        carrier_indices = [
+            indices.get(f"carrier_{color}", None)
+            for indices in (right_indices, left_indices)
+            for color in ("g", "r")
+        ]
+        photom_indices = [
+            indices.get(f"photom_{color}", None)
+            for indices in (right_indices, left_indices)
+            for color in ("g", "r")
+        ]
+
         if data_format == "matlab_data":
             #matlab_data
-            raw_sample_rate = meta_info.get("Processing_Parameters").get("sampling_frequency")
-
-            #Get index of traces
-            trace_indices = meta_info.get("Signal_Indices")
-            carrier_g_right = matlab_data[trace_indices.get("right").get("carrier_g", None)]
-            carrier_r_right =matlab_data[trace_indices.get("right").get("carrier_r", None)]
-            photom_g_right = matlab_data[trace_indices.get("right").get("photom_g", None)]
-            photom_r_right = matlab_data[trace_indices.get("right").get("photom_r", None)]
-            carrier_g_left = matlab_data[trace_indices.get("left").get("carrier_g", None)]
-            carrier_r_left = matlab_data[trace_indices.get("left").get("carrier_r", None)]
-            photom_g_left = matlab_data[trace_indices.get("left").get("photom_g", None)]
-            photom_r_left = matlab_data[trace_indices.get("left").get("photom_r", None)]
-
-            raw_photom_list: list[dict]=[photom_g_right, photom_r_right, 
-                                         photom_g_left, photom_r_left]
-            raw_carrier_list: list[dict]=[carrier_g_right, carrier_r_right,
-                                            carrier_g_left, carrier_r_left]
+            # Stack channels into contiguous (4, n_samples) arrays for vectorized processing
+            raw_photom = demodulation.stack_channels(
+                [data_struct[idx] for idx in photom_indices]
+            )
+            raw_carrier = demodulation.stack_channels(
+                [data_struct[idx] for idx in carrier_indices]
+            )
+            # Only the stacked copies are used from here on, free the loaded file
+            del data_struct
 
             # Get processing parameters
-            processing_parameters = meta_info.get("Processing_Parameters")
-            beh_synch_signal = processing_parameters.get("behavior_offset", 0)
             window = processing_parameters.get("z_window", 60)
             #process_z = processing_parameters.get("z", False)
-            set_carrier_g_right = processing_parameters.get("left").get("carrier_frequency_g", 0)
-            set_carrier_r_right = processing_parameters.get("left").get("carrier_frequency_r", 0)
-            set_carrier_g_left = processing_parameters.get("right").get("carrier_frequency_g", 0)
-            set_carrier_r_left = processing_parameters.get("right").get("carrier_frequency_r", 0)
+            set_carrier_g_right = processing_parameters.get("right").get("carrier_frequency_g", 0)
+            set_carrier_r_right = processing_parameters.get("right").get("carrier_frequency_r", 0)
+            set_carrier_g_left = processing_parameters.get("left").get("carrier_frequency_g", 0)
+            set_carrier_r_left = processing_parameters.get("left").get("carrier_frequency_r", 0)
             bp_bw = processing_parameters.get("bandpass_bandwidth", 0.5)
-            sampling_Hz = processing_parameters.get("sampling_frequency", None)
             downsample_Hz = processing_parameters.get("downsample_frequency", 200)
             transform = processing_parameters.get("transform", {})
             num_perseg = processing_parameters.get("no_per_segment", 216)
@@ -181,7 +216,7 @@ class FiberPhotometry(dj.Imported):
                                             set_carrier_g_left, set_carrier_r_left]
             
             # Get calculated carrier freqeuncy from matlab_data
-            calc_carry_list = demodulation.calc_carry(raw_carrier_list, sampling_Hz)
+            calc_carry_list = demodulation.calc_carry(raw_carrier, sampling_Hz)
             for i in range(len(set_carrier_list)):
                     if calc_carry_list[i] != (set_carrier_list[i] >= calc_carry_list[i]+5 or set_carrier_list[i] <= calc_carry_list[i]-5):
                         warnings.warn("Calculated carrier frequency does not match set carrier frequency. Using calculated carrier frequency.")
@@ -189,531 +224,95 @@ class FiberPhotometry(dj.Imported):
                     else:
                         calc_carry_list = calc_carry_list
             
-            four_list = demodulation.four(raw_photom_list)
             #demodulate photometry data
-            z1_trace_list, power_spectra_list, t_list, spect_power_list = demodulation.process_trace(
-                                raw_photom_list, calc_carry_list,
-                                sampling_Hz, window1, num_perseg, n_overlap)
-            
-            # Store data in this list for ingestion
-            fiber_list: list[dict] = []
-            demodulated_trace_list: list[dict] = []
-
-            fibers: list[str] = [ "right", "left"]
-
-            side_to_fiber_id_mapping = {"right": 1, "left": 2}
-            color_mapping = {"g": "green", "r": "red", "b": "blue"}
-
-        # Get photometry traces for each fiber
-            for fiber in fibers:
-                 
-                fiber_notes = meta_info.get("Fiber").get("implantation").get(f'{fiber}').get("notes", None)
-                #fiber_diam = meta_info.get("Fiber").get("fiber_diameter", None)
-                #hemisphere = meta_info.get("Experiment").get("hemisphere")
-                fiber_list.append(
-                    {
-                        **key,
-                        "fiber_id": side_to_fiber_id_mapping[fiber],
-                        "hemisphere": fiber,
-                        "notes": fiber_notes,
-                    }
-                    )
-            
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                traceNames = {key: trace_names[key] for key in ['photom_g', 'photom_r', 'carrier_g', 'carrier_r']}
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                for trace_name in traceNames:
-
-                    # Populate EmissionColor if present
-                    emission_color = color_mapping[trace_name.split("_")[1][0]]
-
-                    emission_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("emission_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    EmissionColor.insert1(
-                        {
-                            "emission_color": emission_color,
-                            "wavelength": emission_wavelength,
-                        },
-                        skip_duplicates=True,
-                    )
-
-                    # Populate SensorProtein if present
-                    sensor_protein = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}', {})
-                        .get("sensor_protein", {})
-                        .get(emission_color, None)
-                    )
-                    if sensor_protein:
-                        logger.info(
-                            f"{sensor_protein} is inserted into {__name__}.SensorProtein"
-                        )
-                        SensorProtein.insert1(
-                            {"sensor_protein_name": sensor_protein}, skip_duplicates=True
-                        )
-
-                    # Populate ExcitationWavelength if present
-                    excitation_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("excitation_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    if excitation_wavelength:
-                        logger.info(
-                            f"{excitation_wavelength} is inserted into {__name__}.ExcitationWavelength"
-                        )
-                        ExcitationWavelength.insert1(
-                            {"excitation_wavelength": excitation_wavelength},
-                            skip_duplicates=True,
-                        )
-                    
-                    raw_photom_list: list[dict]=[photom_g_right, photom_r_right, 
-                                            photom_g_left, photom_r_left]
-                    raw_carrier_list: list[dict]=[carrier_g_right, carrier_r_right,
-                                                carrier_g_left, carrier_r_left]
-                    carrier_ind = {"g_right":0, "r_right":1, "g_left":2, "r_left":3}
-                    carrier_frequency = calc_carry_list[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    demod_trace = spect_power_list[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    if carrier_frequency:
-                        logger.info(
-                            f"{carrier_frequency} is inserted into {__name__}.CarrierFrequency"
-                        )
-                        CarrierFrequency.insert1(
-                            {"carrier_frequency": carrier_frequency},
-                            skip_duplicates=True,
-                        )
-                        
-                    demodulated_trace_list.append(
-                        {
-                            **key,
-                            "fiber_id": side_to_fiber_id_mapping[fiber],
-                            "hemisphere": fiber,
-                            "trace_name": trace_name.split("_")[0],
-                            "emission_color": emission_color,
-                            "sensor_protein_name": sensor_protein,
-                            "excitation_wavelength": excitation_wavelength,
-                            "carrier_frequency": carrier_frequency,
-                            "demod_sample_rate": carrier_frequency,
-                            "trace": demod_trace,
-                        }
-                    )
-
-            # Populate FiberPhotometry
-            logger.info(f"Populate {__name__}.FiberPhotometry")
-            self.insert1(
-                {
-                    **key,
-                    "light_source_name": light_source_name,
-                    "raw_sample_rate": raw_sample_rate,
-                    "beh_synch_signal": beh_synch_signal,
-                }
-            )
-
-            # Populate FiberPhotometry.Fiber
-            logger.info(f"Populate {__name__}.FiberPhotometry.Fiber")
-            self.Fiber.insert(fiber_list)
-
-            # Populate FiberPhotometry.DemodulatedTrace
-            logger.info(f"Populate {__name__}.FiberPhotometry.DemodulatedTrace")
-            self.DemodulatedTrace.insert(demodulated_trace_list)
-            
-
-            del matlab_data
+            # Only the demodulated traces (spectrogram power) are ingested, so only
+            # they are kept from process_trace's outputs
+            demod_traces = demodulation.process_trace(
+                                raw_photom, calc_carry_list,
+                                sampling_Hz, window1, num_perseg, n_overlap)[3]
+            del raw_photom, raw_carrier
+
+            carrier_frequencies = calc_carry_list
             #matlab_data
             
         elif data_format == "demux_matlab_data":
             #demux_matlab_data
-            
-            raw_sample_rate = None
-            sampling_Hz = meta_info.get("Processing_Parameters").get("sampling_frequency")
-            beh_synch_signal = demux_matlab_data[0]["time_offset"]
-
-            #Get index of traces
-            trace_indices = meta_info.get("Signal_Indices")
-            carrier_g_right = trace_indices.get("right").get("carrier_g", None)
-            carrier_r_right =trace_indices.get("right").get("carrier_r", None)
-            photom_g_right = trace_indices.get("right").get("photom_g", None)
-            photom_r_right = trace_indices.get("right").get("photom_r", None)
-            carrier_g_left = trace_indices.get("left").get("carrier_g", None)
-            carrier_r_left = trace_indices.get("left").get("carrier_r", None)
-            photom_g_left = trace_indices.get("left").get("photom_g", None)
-            photom_r_left = trace_indices.get("left").get("photom_r", None)
-
-            # Get demodulated sample rate
-            demod_sampling: list[float] = []
-            demod_sampling.append(demux_matlab_data[carrier_g_right]["demux_freq"])
-            demod_sampling.append(demux_matlab_data[carrier_r_right]["demux_freq"])
-            demod_sampling.append(demux_matlab_data[carrier_g_left]["demux_freq"])
-            demod_sampling.append(demux_matlab_data[carrier_r_left]["demux_freq"])
-                       
-            
-            # Store data in this list for ingestion
-            fiber_list: list[dict] = []
-            demodulated_trace_list: list[dict] = []
-
-            fiber_list: list[dict] = []
-            demodulated_trace_list: list[dict] = []
-
-            fibers: list[str] = [ "right", "left"]
+            beh_synch_signal = data_struct[0]["time_offset"]
 
-            side_to_fiber_id_mapping = {"right": 1, "left": 2}
-            color_mapping = {"g": "green", "r": "red", "b": "blue"}
+            # Get demodulated sample rate and traces
+            carrier_frequencies = [data_struct[idx]["demux_freq"] for idx in carrier_indices]
+            ##pull out the data from the matlab file
+            demod_traces = [data_struct[idx]["data"] for idx in photom_indices]
 
-            # Get photometry traces for each fiber
-            for fiber in fibers:
-                 
-                fiber_notes = meta_info.get("Fiber").get("implantation").get(f'{fiber}').get("notes", None)
-                #fiber_diam = meta_info.get("Fiber").get("fiber_diameter", None)
-                #hemisphere = meta_info.get("Experiment").get("hemisphere")
-                fiber_list.append(
-                    {
-                        **key,
-                        "fiber_id": side_to_fiber_id_mapping[fiber],
-                        "hemisphere": fiber,
-                        "notes": fiber_notes,
-                    }
-                    )
-                
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                traceNames = {key: trace_names[key] for key in ['photom_g', 'photom_r', 'carrier_g', 'carrier_r']}
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                for trace_name in traceNames:
-
-                    # Populate EmissionColor if present
-                    emission_color = color_mapping[trace_name.split("_")[1][0]]
-
-                    emission_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("emission_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    EmissionColor.insert1(
-                        {
-                            "emission_color": emission_color,
-                            "wavelength": emission_wavelength,
-                        },
-                        skip_duplicates=True,
-                    )
-
-                    # Populate SensorProtein if present
-                    sensor_protein = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}', {})
-                        .get("sensor_protein", {})
-                        .get(emission_color, None)
-                    )
-                    if sensor_protein:
-                        logger.info(
-                            f"{sensor_protein} is inserted into {__name__}.SensorProtein"
-                        )
-                        SensorProtein.insert1(
-                            {"sensor_protein_name": sensor_protein}, skip_duplicates=True
-                        )
-
-                    # Populate ExcitationWavelength if present
-                    excitation_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("excitation_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    if excitation_wavelength:
-                        logger.info(
-                            f"{excitation_wavelength} is inserted into {__name__}.ExcitationWavelength"
-                        )
-                        ExcitationWavelength.insert1(
-                            {"excitation_wavelength": excitation_wavelength},
-                            skip_duplicates=True,
-                        )
-
-                    ##pull out the data from the matlab file
-                    photometry_demux_g_left = demux_matlab_data[photom_g_left]['data']
-                    photometry_demux_r_left = demux_matlab_data[photom_r_left]['data']
-                    photometry_demux_g_right = demux_matlab_data[photom_g_right]['data']
-                    photometry_demux_r_right = demux_matlab_data[photom_r_right]['data']
-                    demux_trace_list: list[dict] = []
-                    demux_trace_list.append(photometry_demux_g_right)
-                    demux_trace_list.append(photometry_demux_r_right)
-                    demux_trace_list.append(photometry_demux_g_left)
-                    demux_trace_list.append(photometry_demux_r_left)
-
-                    carrier_ind = {"g_right":0, "r_right":1, "g_left":2, "r_left":3}
-                    carrier_frequency = demod_sampling[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    demod_trace = demux_trace_list[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    if carrier_frequency:
-                        logger.info(
-                            f"{carrier_frequency} is inserted into {__name__}.CarrierFrequency"
-                        )
-                        CarrierFrequency.insert1(
-                            {"carrier_frequency": carrier_frequency},
-                            skip_duplicates=True,
-                        )
-                    
-                                    
-                    demodulated_trace_list.append(
-                            {
-                                **key,
-                                "fiber_id": side_to_fiber_id_mapping[fiber],
-                                "hemisphere": fiber,
-                                "trace_name": trace_name.split("_")[0],
-                                "emission_color": emission_color,
-                                "sensor_protein_name": sensor_protein,
-                                "excitation_wavelength": excitation_wavelength,
-                                "carrier_frequency": carrier_frequency,
-                                "demod_sample_rate": carrier_frequency,
-                                "trace": demod_trace,
-                            }
-                        )
-                    
-                # Populate FiberPhotometry
-            logger.info(f"Populate {__name__}.FiberPhotometry")
-            self.insert1(
-                        {
-                            **key,
-                            "light_source_name": light_source_name,
-                            "raw_sample_rate": sampling_Hz,
-                            "beh_synch_signal": beh_synch_signal,
-                        }
-                    )
-
-                    # Populate FiberPhotometry.Fiber
-            logger.info(f"Populate {__name__}.FiberPhotometry.Fiber")
-            self.Fiber.insert(fiber_list)
-
-                    # Populate FiberPhotometry.DemodulatedTrace
-            logger.info(f"Populate {__name__}.FiberPhotometry.DemodulatedTrace")
-            self.DemodulatedTrace.insert(demodulated_trace_list)
-
-            del demux_matlab_data
+            # The traces are all that is kept, free the rest of the loaded file
+            del data_struct
             #demux_matlab_data
 
-        if data_format == "demux_matlab_data_mat73":
+        elif data_format == "demux_matlab_data_mat73":
             #demux_matlab_data_mat73
-            
-            raw_sample_rate = None
-            sampling_Hz = meta_info.get("Processing_Parameters").get("sampling_frequency")
-            beh_synch_signal = demux_matlab_data["time_offset"][0]
-
-            #Get index of traces
-            trace_indices = meta_info.get("Signal_Indices")
-            carrier_g_right = trace_indices.get("right").get("carrier_g", None)
-            carrier_r_right =trace_indices.get("right").get("carrier_r", None)
-            photom_g_right = trace_indices.get("right").get("photom_g", None)
-            photom_r_right = trace_indices.get("right").get("photom_r", None)
-            carrier_g_left = trace_indices.get("left").get("carrier_g", None)
-            carrier_r_left = trace_indices.get("left").get("carrier_r", None)
-            photom_g_left = trace_indices.get("left").get("photom_g", None)
-            photom_r_left = trace_indices.get("left").get("photom_r", None)
-
-            # Get demodulated sample rate
-            demod_sampling: list[float] = []
-            demod_sampling.append(demux_matlab_data["demux_freq"][carrier_g_right] if carrier_g_right is not None else None)
-            demod_sampling.append(demux_matlab_data["demux_freq"][carrier_r_right] if carrier_r_right is not None else None)
-            demod_sampling.append(demux_matlab_data["demux_freq"][carrier_g_left] if carrier_g_left is not None else None)
-            demod_sampling.append(demux_matlab_data["demux_freq"][carrier_r_left] if carrier_r_left is not None else None)
-
-            # Store data in this list for ingestion
-            fiber_list: list[dict] = []
-            demodulated_trace_list: list[dict] = []
-
-            fiber_list: list[dict] = []
-            demodulated_trace_list: list[dict] = []
-
-            fibers: list[str] = [ "right", "left"]
-
-            side_to_fiber_id_mapping = {"right": 1, "left": 2}
-            color_mapping = {"g": "green", "r": "red", "b": "blue"}
-
-            # Get photometry traces for each fiber
-            for fiber in fibers:
-                 
-                fiber_notes = meta_info.get("Fiber").get("implantation").get(f'{fiber}').get("notes", None)
-                #fiber_diam = meta_info.get("Fiber").get("fiber_diameter", None)
-                #hemisphere = meta_info.get("Experiment").get("hemisphere")
-                fiber_list.append(
-                    {
-                        **key,
-                        "fiber_id": side_to_fiber_id_mapping[fiber],
-                        "hemisphere": fiber,
-                        "notes": fiber_notes,
-                    }
-                    )
-                
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                traceNames = {key: trace_names[key] for key in ['photom_g', 'photom_r', 'carrier_g', 'carrier_r'] if key in trace_names}
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                for trace_name in traceNames:
-
-                    # Populate EmissionColor if present
-                    emission_color = color_mapping[trace_name.split("_")[1][0]]
-
-                    emission_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("emission_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    EmissionColor.insert1(
-                        {
-                            "emission_color": emission_color,
-                            "wavelength": emission_wavelength,
-                        },
-                        skip_duplicates=True,
-                    )
-
-                    # Populate SensorProtein if present
-                    sensor_protein = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}', {})
-                        .get("sensor_protein", {})
-                        .get(emission_color, None)
-                    )
-                    if sensor_protein:
-                        logger.info(
-                            f"{sensor_protein} is inserted into {__name__}.SensorProtein"
-                        )
-                        SensorProtein.insert1(
-                            {"sensor_protein_name": sensor_protein}, skip_duplicates=True
-                        )
-
-                    # Populate ExcitationWavelength if present
-                    excitation_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("excitation_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    if excitation_wavelength:
-                        logger.info(
-                            f"{excitation_wavelength} is inserted into {__name__}.ExcitationWavelength"
-                        )
-                        ExcitationWavelength.insert1(
-                            {"excitation_wavelength": excitation_wavelength},
-                            skip_duplicates=True,
-                        )
-                    ##pull out the data from the matlab file
-                    photometry_demux_g_left = (demux_matlab_data['data'][photom_g_left] if photom_g_left is not None else None)
-                    photometry_demux_r_left = (demux_matlab_data['data'][photom_r_left] if photom_r_left is not None else None)
-                    photometry_demux_g_right = (demux_matlab_data['data'][photom_g_right] if photom_g_right is not None else None)
-                    photometry_demux_r_right = (demux_matlab_data['data'][photom_r_right] if photom_r_right is not None else None)
-                    demux_trace_list: list[dict] = []
-                    demux_trace_list.append(photometry_demux_g_right)
-                    demux_trace_list.append(photometry_demux_r_right)
-                    demux_trace_list.append(photometry_demux_g_left)
-                    demux_trace_list.append(photometry_demux_r_left)
-
-                    carrier_ind = {"g_right":0, "r_right":1, "g_left":2, "r_left":3}
-                    carrier_frequency = demod_sampling[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    demod_trace = demux_trace_list[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    if carrier_frequency:
-                        logger.info(
-                            f"{carrier_frequency} is inserted into {__name__}.CarrierFrequency"
-                        )
-                        CarrierFrequency.insert1(
-                            {"carrier_frequency": carrier_frequency},
-                            skip_duplicates=True,
-                        )
-                    
-                                    
-                    demodulated_trace_list.append(
-                            {
-                                **key,
-                                "fiber_id": side_to_fiber_id_mapping[fiber],
-                                "hemisphere": fiber,
-                                "trace_name": trace_name.split("_")[0],
-                                "emission_color": emission_color,
-                                "sensor_protein_name": sensor_protein,
-                                "excitation_wavelength": excitation_wavelength,
-                                "carrier_frequency": carrier_frequency,
-                                "demod_sample_rate": carrier_frequency,
-                                "trace": demod_trace,
-                            }
-                        )
-                    
-                # Populate FiberPhotometry
-            logger.info(f"Populate {__name__}.FiberPhotometry")
-            self.insert1(
-                        {
-                            **key,
-                            "light_source_name": light_source_name,
-                            "raw_sample_rate": sampling_Hz,
-                            "beh_synch_signal": beh_synch_signal,
-                        }
-                    )
-
-                    # Populate FiberPhotometry.Fiber
-            logger.info(f"Populate {__name__}.FiberPhotometry.Fiber")
-            self.Fiber.insert(fiber_list)
-
-                    # Populate FiberPhotometry.DemodulatedTrace
-            logger.info(f"Populate {__name__}.FiberPhotometry.DemodulatedTrace")
-            self.DemodulatedTrace.insert(demodulated_trace_list)
-
-            del demux_matlab_data
-            #demux_matlab_data_mat73
-                
+            data_struct = _read_mat73_timeseries(
+                photometry_file, carrier_indices, photom_indices
+            )
+            beh_synch_signal = data_struct["time_offset"][0]
+
+            # Get demodulated sample rate and traces
+            carrier_frequencies = [
+                data_struct["demux_freq"][idx] if idx is not None else None
+                for idx in carrier_indices
+            ]
+            ##pull out the data from the matlab file
+            demod_traces = [
+                data_struct["data"][idx] if idx is not None else None
+                for idx in photom_indices
+            ]
 
+            del data_struct
+            #demux_matlab_data_mat73
 
         elif data_format == "tdt_data":
             #tdt_data             
                         
             # Get trace indices from meta_info
-            trace_indices = meta_info.get("Signal_Indices")
-            carrier_g_right = tdt_data.streams.Fi1r.data[trace_indices.get("right").get("carrier_g", None)]
-            carrier_r_right =tdt_data.streams.Fi1r.data[trace_indices.get("right").get("carrier_r", None)]
-            photom_g_right = tdt_data.streams.Fi1r.data[trace_indices.get("right").get("photom_g", None)]
-            photom_r_right = tdt_data.streams.Fi1r.data[trace_indices.get("right").get("photom_r", None)]
-            carrier_g_left = tdt_data.streams.Fi2r.data[trace_indices.get("left").get("carrier_g", None)]
-            carrier_r_left = tdt_data.streams.Fi2r.data [trace_indices.get("left").get("carrier_r", None)]
-            photom_g_left = tdt_data.streams.Fi2r.data[trace_indices.get("left").get("photom_g", None)]
-            photom_r_left = tdt_data.streams.Fi2r.data[trace_indices.get("left").get("photom_r", None)]
-
-            #Get trace names and store in this list for ingestion
-            raw_photom_list: list[dict]=[photom_g_right, photom_r_right, 
-                                         photom_g_left, photom_r_left]
-            raw_carrier_list: list[dict]=[carrier_g_right, carrier_r_right,
-                                            carrier_g_left, carrier_r_left]
+            carrier_g_right = tdt_data.streams.Fi1r.data[right_indices.get("carrier_g", None)]
+            carrier_r_right = tdt_data.streams.Fi1r.data[right_indices.get("carrier_r", None)]
+            photom_g_right = tdt_data.streams.Fi1r.data[right_indices.get("photom_g", None)]
+            photom_r_right = tdt_data.streams.Fi1r.data[right_indices.get("photom_r", None)]
+            carrier_g_left = tdt_data.streams.Fi2r.data[left_indices.get("carrier_g", None)]
+            carrier_r_left = tdt_data.streams.Fi2r.data[left_indices.get("carrier_r", None)]
+            photom_g_left = tdt_data.streams.Fi2r.data[left_indices.get("photom_g", None)]
+            photom_r_left = tdt_data.streams.Fi2r.data[left_indices.get("photom_r", None)]
+
+            # Stack channels into contiguous (4, n_samples) arrays for vectorized processing
+            raw_photom = demodulation.stack_channels([photom_g_right, photom_r_right, 
+                                                      photom_g_left, photom_r_left])
+            raw_carrier = demodulation.stack_channels([carrier_g_right, carrier_r_right,
+                                                       carrier_g_left, carrier_r_left])
+            # The stacked arrays are copies, drop the views into the TDT block so that
+            # the block (epocs, snips, unused streams) can be released once stacked
+            del (carrier_g_right, carrier_r_right, photom_g_right, photom_r_right,
+                 carrier_g_left, carrier_r_left, photom_g_left, photom_r_left)
+            transform = processing_parameters.get("transform", {})
+            if transform != "hilbert":
+                # only the hilbert path reads the raw block again
+                del tdt_data
 
-            
             # Get processing parameters
-            processing_parameters = meta_info.get("Processing_Parameters")
-            beh_synch_signal = processing_parameters.get("behavior_offset", 0)
             window = processing_parameters.get("z_window", 60)
             process_z = processing_parameters.get("z", False)
-            set_carrier_g_right = processing_parameters.get("left").get("carrier_frequency_g", 0)
-            set_carrier_r_right = processing_parameters.get("left").get("carrier_frequency_r", 0)
-            set_carrier_g_left = processing_parameters.get("right").get("carrier_frequency_g", 0)
-            set_carrier_r_left = processing_parameters.get("right").get("carrier_frequency_r", 0)
+            set_carrier_g_right = processing_parameters.get("right").get("carrier_frequency_g", 0)
+            set_carrier_r_right = processing_parameters.get("right").get("carrier_frequency_r", 0)
+            set_carrier_g_left = processing_parameters.get("left").get("carrier_frequency_g", 0)
+            set_carrier_r_left = processing_parameters.get("left").get("carrier_frequency_r", 0)
             bp_bw = processing_parameters.get("bandpass_bandwidth", 0.5)
-            sampling_Hz = processing_parameters.get("sampling_frequency", None)
             downsample_Hz = processing_parameters.get("downsample_frequency", 200)
             demod_sample_rate = processing_parameters.get("demod_sample_rate", 200)
-            transform = processing_parameters.get("transform", {})
             num_perseg = processing_parameters.get("no_per_segment", 216)
             n_overlap = processing_parameters.get("noverlap", 108)
 
             set_carrier_list: list[dict]=[set_carrier_g_right, set_carrier_r_right,
                                             set_carrier_g_left, set_carrier_r_left]
             
-            calc_carry_list = demodulation.calc_carry(raw_carrier_list, sampling_Hz)
+            calc_carry_list = demodulation.calc_carry(raw_carrier, sampling_Hz)
 
             for i in range(len(set_carrier_list)):
                     if calc_carry_list[i] != (set_carrier_list[i] >= calc_carry_list[i]+5 or set_carrier_list[i] <= calc_carry_list[i]-5):
@@ -727,18 +326,12 @@ class FiberPhotometry(dj.Imported):
 
             # Process traces
             if transform == "spectrogram":
-                calc_carry_list = demodulation.calc_carry(raw_carrier_list, sampling_Hz)
-                for i in range(len(set_carrier_list)):
-                    if calc_carry_list[i] != (set_carrier_list[i] >= calc_carry_list[i]+5 or set_carrier_list[i] <= calc_carry_list[i]-5):
-                        warnings.warn("Calculated carrier frequency does not match set carrier frequency. Using calculated carrier frequency.")
-                        set_carrier_list = calc_carry_list
-                else:
-                    calc_carry_list = calc_carry_list
-
-                four_list = demodulation.four(raw_photom_list)
-                z1_trace_list, power_spectra_list, t_list, spect_power_list = demodulation.process_trace(
-                                raw_photom_list, calc_carry_list,
-                                sampling_Hz, window1, num_perseg, n_overlap)                 
+                # Only the demodulated traces (spectrogram power) are ingested, so only
+                # they are kept from process_trace's outputs
+                demod_traces = demodulation.process_trace(
+                                raw_photom, calc_carry_list,
+                                sampling_Hz, window1, num_perseg, n_overlap)[3]
+                del raw_photom, raw_carrier
             elif transform == "hilbert":
                 fiber_to_side_mapping = {1: "right", 2: "left"}
                 color_mapping = {"g": "green", "r": "red", "b": "blue"}
@@ -747,145 +340,41 @@ class FiberPhotometry(dj.Imported):
                 photometry_df, fibers, raw_sample_rate = demodulation.offline_demodulation(
                 tdt_data, z=True, tau=0.05, downsample_fs=demod_sample_rate, bandpass_bw=20
                 )
+                del tdt_data
 
-            #loop through each trace in raw_photom_list and raw_carrier_list
-            #return the demodulated traces
-            
-          
-        # Store data in this list for ingestion
-            fiber_list: list[dict] = []
-            demodulated_trace_list: list[dict] = []
-                   
-            fibers: list[str] = [ "right", "left"]
-
-            side_to_fiber_id_mapping = {"right": 1, "left": 2}
-            color_mapping = {"g": "green", "r": "red", "b": "blue"}
-
-        # Get photometry traces for each fiber
-            for fiber in fibers:
-                 
-                fiber_notes = meta_info.get("Fiber").get("implantation").get(f'{fiber}').get("notes", None)
-                #fiber_diam = meta_info.get("Fiber").get("fiber_diameter", None)
-                #hemisphere = meta_info.get("Experiment").get("hemisphere")
-                fiber_list.append(
-                    {
-                        **key,
-                        "fiber_id": side_to_fiber_id_mapping[fiber],
-                        "hemisphere": fiber,
-                        "notes": fiber_notes,
-                    }
-                    )
-            
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                traceNames = {key: trace_names[key] for key in ['photom_g', 'photom_r', 'carrier_g', 'carrier_r']}
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                for trace_name in traceNames:
-
-
-                    # Populate EmissionColor if present
-                    emission_color = color_mapping[trace_name.split("_")[1][0]]
-
-                    emission_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("emission_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    EmissionColor.insert1(
-                        {
-                            "emission_color": emission_color,
-                            "wavelength": emission_wavelength,
-                        },
-                        skip_duplicates=True,
-                    )
-
-                    # Populate SensorProtein if present
-                    sensor_protein = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}', {})
-                        .get("sensor_protein", {})
-                        .get(emission_color, None)
-                    )
-                    if sensor_protein:
-                        logger.info(
-                            f"{sensor_protein} is inserted into {__name__}.SensorProtein"
-                        )
-                        SensorProtein.insert1(
-                            {"sensor_protein_name": sensor_protein}, skip_duplicates=True
-                        )
-
-                    # Populate ExcitationWavelength if present
-                    excitation_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("excitation_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    if excitation_wavelength:
-                        logger.info(
-                            f"{excitation_wavelength} is inserted into {__name__}.ExcitationWavelength"
-                        )
-                        ExcitationWavelength.insert1(
-                            {"excitation_wavelength": excitation_wavelength},
-                            skip_duplicates=True,
-                        )
-                    
-                    raw_photom_list: list[dict]=[photom_g_right, photom_r_right, 
-                                            photom_g_left, photom_r_left]
-                    raw_carrier_list: list[dict]=[carrier_g_right, carrier_r_right,
-                                                carrier_g_left, carrier_r_left]
-                    carrier_ind = {"g_right":0, "r_right":1, "g_left":2, "r_left":3}
-                    carrier_frequency = calc_carry_list[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    demod_trace = spect_power_list[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    if carrier_frequency:
-                        logger.info(
-                            f"{carrier_frequency} is inserted into {__name__}.CarrierFrequency"
-                        )
-                        CarrierFrequency.insert1(
-                            {"carrier_frequency": carrier_frequency},
-                            skip_duplicates=True,
-                        )
-                        
-                    demodulated_trace_list.append(
-                        {
-                            **key,
-                            "fiber_id": side_to_fiber_id_mapping[fiber],
-                            "hemisphere": fiber,
-                            "trace_name": trace_name.split("_")[0],
-                            "emission_color": emission_color,
-                            "sensor_protein_name": sensor_protein,
-                            "excitation_wavelength": excitation_wavelength,
-                            "carrier_frequency": carrier_frequency,
-                            "demod_sample_rate": carrier_frequency,
-                            "trace": demod_trace,
-                        }
-                    )
-            
-            # Populate FiberPhotometry
-            logger.info(f"Populate {__name__}.FiberPhotometry")
-            self.insert1(
-                {
-                    **key,
-                    "light_source_name": light_source_name,
-                    "raw_sample_rate": sampling_Hz,
-                    "beh_synch_signal": beh_synch_signal,
-                }
-            )
+            carrier_frequencies = calc_carry_list
+            #tdt_data
 
-            # Populate FiberPhotometry.Fiber
-            logger.info(f"Populate {__name__}.FiberPhotometry.Fiber")
-            self.Fiber.insert(fiber_list)
+        # Store data in these lists for ingestion
+        fiber_list, demodulated_trace_list, lookup_rows = _get_fiber_entries(
+            key, meta_info, carrier_frequencies, demod_traces
+        )
+        # the rows hold float32 copies, release the original traces before inserting
+        del demod_traces
+
+        # populate() runs make() in a single transaction, so the lookup, master and
+        # part inserts below are committed together (or not at all)
+        _insert_lookup_rows(lookup_rows)
+
+        # Populate FiberPhotometry
+        logger.info(f"Populate {__name__}.FiberPhotometry")
+        self.insert1(
+            {
+                **key,
+                "light_source_name": light_source_name,
+                "raw_sample_rate": sampling_Hz,
+                "beh_synch_signal": beh_synch_signal,
+            }
+        )
+
+        # Populate FiberPhotometry.Fiber
+        logger.info(f"Populate {__name__}.FiberPhotometry.Fiber")
+        self.Fiber.insert(fiber_list)
+
+        # Populate FiberPhotometry.DemodulatedTrace
+        logger.info(f"Populate {__name__}.FiberPhotometry.DemodulatedTrace")
+        self.DemodulatedTrace.insert(demodulated_trace_list)
 
-            # Populate FiberPhotometry.DemodulatedTrace
-            logger.info(f"Populate {__name__}.FiberPhotometry.DemodulatedTrace")
-            self.DemodulatedTrace.insert(demodulated_trace_list)
-            
-            del tdt_data
-            #tdt_data
 
 @schema
 class FiberPhotometrySynced(dj.Imported):
@@ -904,7 +393,7 @@ class FiberPhotometrySynced(dj.Imported):
         trace_name          : varchar(8)  # (e.g., raw, detrend)
         -> EmissionColor
         ---
-        trace      : longblob  
+        trace      : longblob  # synced photometry trace (float32)
         """
 
     def make(self, key):
@@ -914,28 +403,13 @@ class FiberPhotometrySynced(dj.Imported):
         behavior_dir = session_full_dir / "Behavior"
         # Get meta info
         meta_info_file = list(behavior_dir.glob("*.toml"))[0]
-        meta_info = {}
-        try:
-            with open(meta_info_file, "rb") as f:
-                meta_info = tomli.load(f)
-        except FileNotFoundError:
-            logger.info("meta info is missing")
+        meta_info = _load_meta_info(meta_info_file, ["Processing_Parameters"])
         processing_parameters = meta_info.get("Processing_Parameters")
         transform = processing_parameters.get("transform", {})
 
         if transform == "hilbert":
 
             # Parameters
-            get_fiber_id = (
-                lambda side: 1 if side.lower().startswith("r") else 2
-            )  # map hemisphere to fiber id
-            get_color = (
-                lambda s: "green"
-                if s.lower().startswith("g")
-                else "red"
-                if s.lower().startswith("r")
-                else None
-            )
             color_mapping = {"green": "grn"}
             synch_signal_names = ["toBehSys", "fromBehSys"]
             behavior_sample_rate = 200  # original behavioral sampling freq (Hz)
@@ -952,112 +426,108 @@ class FiberPhotometrySynced(dj.Imported):
             # Fetch demodulated photometry traces from FiberPhotometry table
             query = (FiberPhotometry.Fiber * FiberPhotometry.DemodulatedTrace) & key
 
-            photometry_dict = {}
-
-            for row in query:
-                trace_name = (
-                    "_".join([row["trace_name"], color_mapping[row["emission_color"]]])
-                    + row["hemisphere"][0].upper()
-                )
-                trace = row["trace"]
-                photometry_dict[trace_name] = trace
-
-            photometry_df = pd.DataFrame(
-                (FiberPhotometry & key).fetch1("beh_synch_signal") | photometry_dict
+            # One bulk fetch instead of iterating the query row by row
+            rows = query.fetch(
+                "trace_name", "emission_color", "hemisphere", "trace", as_dict=True
             )
+            photometry_dict = {
+                "_".join([row["trace_name"], color_mapping[row["emission_color"]]])
+                + row["hemisphere"][0].upper(): row["trace"]
+                for row in rows
+            }
+            del rows
+
+            # handshake_behav_recording_sys needs a DataFrame, build it straight from
+            # the arrays rather than from a merged copy of both dicts
+            synch_signals = (FiberPhotometry & key).fetch1("beh_synch_signal")
+            photometry_df = pd.DataFrame({**synch_signals, **photometry_dict}, copy=False)
+            del synch_signals, photometry_dict
             # Get trace names e.g., ["detrend_grnR", "raw_grnR"]
             trace_names: list[dict] = photometry_df.columns.drop(synch_signal_names).tolist()
 
             # Update df to start with first trial pulse from behavior system
             photometry_df = pp.handshake_behav_recording_sys(photometry_df)
 
+            # Task state columns kept from the analog data
+            state_columns = [
+                "nTrial",
+                "iBlock",
+                "Cue",
+                "ENL",
+                "Select",
+                "Consumption",
+                "iSpout",
+                "stateConsumption",
+                "ENLP",
+                "CueP",
+                "nENL",
+                "nCue",
+            ]
+
+            # Only parse the columns used below, the index column is the first one
+            analog_file = behavior_dir / f"{subject_id}_analog_filled.csv"
+            analog_index_col = pd.read_csv(analog_file, nrows=0).columns[0]
             analog_df: pd.DataFrame = pd.read_csv(
-                behavior_dir / f"{subject_id}_analog_filled.csv", index_col=0
+                analog_file,
+                index_col=0,
+                usecols=[analog_index_col, *state_columns],
+                engine="c",
             )
-            analog_df["session_clock"] = analog_df.index * 0.005
+            # 5 ms per analog sample, attached to the aligned rows by resample_and_align
+            session_clock = analog_df.index.to_numpy(dtype=np.float64) * 0.005
 
             # Resample the photometry data and align to 200 Hz state transition behavioral data (analog_df)
+            # (only the per-trial penalty counts are needed from the behavior table)
             behavior_df: pd.DataFrame = pd.read_csv(
-                behavior_dir / f"{subject_id}_behavior_df_full.csv", index_col=0
+                behavior_dir / f"{subject_id}_behavior_df_full.csv",
+                usecols=["nTrial", "n_ENL", "n_Cue"],
+                engine="c",
             )
 
             aligned_behav_photo_df, time_offset = pp.resample_and_align(
-                analog_df, photometry_df, channels=trace_names
+                analog_df, photometry_df, channels=trace_names, session_clock=session_clock
             )
-            del analog_df
+            del analog_df, session_clock
 
             # One more rolling z-score over the window length (60s * sampling freq (200Hz))
             win = round(60 * 200)
 
-            for channel in trace_names:
-                if "detrend" in channel:
-                    aligned_behav_photo_df[
-                        f'z_{channel.split("_")[-1]}'
-                    ] = demodulation.rolling_z(aligned_behav_photo_df[channel], wn=win)
-            aligned_behav_photo_df = aligned_behav_photo_df.iloc[win:-win].reset_index(
-                drop=True
-            )  # drop edges that now contain NaNs from rolling window
+            # All detrended channels are scored in one call, one row per channel
+            detrend_channels = [
+                channel for channel in trace_names if channel.startswith("detrend_")
+            ]
+            # e.g., "detrend_grnR" -> "z_grnR"
+            z_columns = [f'z_{channel.split("_", 1)[1]}' for channel in detrend_channels]
+            if detrend_channels:
+                z_traces = demodulation.rolling_z(
+                    aligned_behav_photo_df[detrend_channels].to_numpy(np.float64).T,
+                    wn=win,
+                )
+                aligned_behav_photo_df[z_columns] = z_traces.T
+                del z_traces
+            # drop edges that now contain NaNs from rolling window (a slice, no copy yet)
+            aligned_behav_photo_df = aligned_behav_photo_df.iloc[win:-win]
 
             # Drop unnecessary columns that we don't need to save
-            photo_columns = trace_names + [
-                f'z_{channel.split("_")[-1]}' for channel in trace_names[::3]
-            ]  # trace_names[::((len(trace_names)//2)+1)]]]
+            photo_columns = trace_names + z_columns
 
-            cols_to_keep = [
-                "nTrial",
-                "iBlock",
-                "Cue",
-                "ENL",
-                "Select",
-                "Consumption",
-                "iSpout",
-                "stateConsumption",
-                "ENLP",
-                "CueP",
-                "nENL",
-                "nCue",
-                "session_clock",
-            ]
-            cols_to_keep.extend(photo_columns)
+            cols_to_keep = [*state_columns, "session_clock", *photo_columns]
 
-            timeseries_task_states_df: pd.DataFrame = deepcopy(
-                aligned_behav_photo_df[cols_to_keep]
-            )
-            timeseries_task_states_df["trial_clock"] = (
-                timeseries_task_states_df.groupby("nTrial").cumcount() * 5 / 1000
-            )
+            # No explicit copy: the columns below are replaced whole, never written in place
+            timeseries_task_states_df: pd.DataFrame = aligned_behav_photo_df[cols_to_keep]
+            # Relabel in place instead of copying every column through reset_index
+            timeseries_task_states_df.index = pd.RangeIndex(len(timeseries_task_states_df))
 
             # This has to happen AFTER alignment between photometry and behavior because first ENL triggers sync pulse
-            _split_penalty_states(timeseries_task_states_df, behavior_df, penalty="ENLP")
-            _split_penalty_states(timeseries_task_states_df, behavior_df, penalty="CueP")
-
-            n_bins, remainder = divmod(
-                len(timeseries_task_states_df), downsample_factor
-            )  # get number of bins to downsample into
-            bin_ids = [
-                j for i in range(int(n_bins)) for j in np.repeat(i, downsample_factor)
-            ]  # define ids of bins at downsampling rate [1,1,1,1,2,2,2,2,...]
-            bin_ids.extend(
-                np.repeat(bin_ids[-1] + 1, remainder)
-            )  # tag on incomplete bin at end
-            timeseries_task_states_df[
-                "bin_ids"
-            ] = bin_ids  # new column to label new bin_ids
-
-            downsampled_states_df: pd.DataFrame = deepcopy(timeseries_task_states_df)
-
-            # Apply aggregate function to each column
-            col_fcns = {
-                col: np.max
-                for col in downsampled_states_df.columns
-                if col not in photo_columns
-            }
-            [col_fcns.update({col: np.mean}) for col in photo_columns]
+            pp.split_penalty_states(
+                timeseries_task_states_df, behavior_df, penalties=("ENLP", "CueP")
+            )
 
-            # Handle penalties. Label preceding states as different from those without penalties
-            downsampled_states_df = downsampled_states_df.groupby("bin_ids").agg(col_fcns)
-            downsampled_states_df = downsampled_states_df.reset_index(drop=True)
-            downsampled_states_df = downsampled_states_df.drop(columns=["bin_ids"])
+            # Downsample in fixed bins of downsample_factor samples: states take the
+            # max over the bin, photometry traces the mean (photometry columns last)
+            downsampled_states_df = pp.downsample_task_states(
+                timeseries_task_states_df, int(downsample_factor), photo_columns
+            )
 
             # Get new
             trace_names = list(downsampled_states_df.columns[-6:])
@@ -1072,35 +542,21 @@ class FiberPhotometrySynced(dj.Imported):
             )
 
             # Populate FiberPhotometry
-            synced_trace_list: list[dict] = []
-
-            for trace_name in trace_names:
-
-                synced_trace_list.append(
-                    {
-                        **key,
-                        "fiber_id": get_fiber_id(trace_name[-1]),
-                        "hemisphere": {"R": "right", "L": "left"}[trace_name[-1]],
-                        "trace_name": trace_name.split("_")[0],
-                        "emission_color": get_color(trace_name.split("_")[1][0]),
-                        "trace": downsampled_states_df[trace_name].values,
-                    }
-                )
+            # float32 is plenty for (z-scored) photometry traces and halves the blobs
+            trace_meta = {name: _parse_synced_trace_name(name) for name in trace_names}
+            synced_trace_list: list[dict] = [
+                {
+                    **key,
+                    **trace_meta[name],
+                    "trace": downsampled_states_df[name].to_numpy(dtype=np.float32),
+                }
+                for name in trace_names
+            ]
 
             self.SyncedTrace.insert(synced_trace_list)
 
         elif transform == "spectrogram":
             # Parameters
-            get_fiber_id = (
-                lambda side: 1 if side.lower().startswith("r") else 2
-            )  # map hemisphere to fiber id
-            get_color = (
-                lambda s: "green"
-                if s.lower().startswith("g")
-                else "red"
-                if s.lower().startswith("r")
-                else None
-            )
             color_mapping = {"green": "green", "red": "red"}
             sampling_Hz = processing_parameters.get("sampling_frequency", 2000)
             behavior_sync_signal = processing_parameters.get("behavior_offset", 0)
@@ -1120,15 +576,16 @@ class FiberPhotometrySynced(dj.Imported):
             # Fetch demodulated photometry traces from FiberPhotometry table
             query = (FiberPhotometry.Fiber * FiberPhotometry.DemodulatedTrace) & key
 
-            photometry_dict = {}
-
-            for row in query:
-                trace_name = (
-                    "_".join([row["trace_name"], color_mapping[row["emission_color"]]])
-                    + row["hemisphere"][0].upper()
-                )
-                trace = row["trace"]
-                photometry_dict[trace_name] = trace
+            # One bulk fetch instead of iterating the query row by row
+            rows = query.fetch(
+                "trace_name", "emission_color", "hemisphere", "trace", as_dict=True
+            )
+            photometry_dict = {
+                "_".join([row["trace_name"], color_mapping[row["emission_color"]]])
+                + row["hemisphere"][0].upper(): row["trace"]
+                for row in rows
+            }
+            del rows
 
             photometry_sync = behavior_sync_signal
             # Get trace names e.g., ["detrend_grnR", "raw_grnR"]
@@ -1181,17 +638,15 @@ class FiberPhotometrySynced(dj.Imported):
             # Populate FiberPhotometry
             synced_trace_list: list[dict] = []
 
+            trace_meta = {name: _parse_synced_trace_name(name) for name in trace_names}
             for index, trace_name in enumerate(trace_names):
 
                 synced_trace_list.append(
                     {
                         **key,
-                        "fiber_id": get_fiber_id(trace_name[-1]),
-                        "hemisphere": {"R": "right", "L": "left"}[trace_name[-1]],
-                        "trace_name": trace_name.split("_")[0],
-                        "emission_color": get_color(trace_name.split("_")[1][0]),
+                        **trace_meta[trace_name],
                         #"trace": alignedData[trace_names.index(trace_name)].values
-                        "trace": alignedData[index],
+                        "trace": np.ascontiguousarray(alignedData[index], dtype=np.float32),
                     }
                 )
 
@@ -1199,42 +654,184 @@ class FiberPhotometrySynced(dj.Imported):
             self.SyncedTrace.insert(synced_trace_list)
 
 
-def _split_penalty_states(
-    df: pd.DataFrame, behavior_df: pd.DataFrame, penalty: str = "ENLP"
-    ) -> None:
-    """Handle penalties. Label preceding states as different from those without penalties"""
-    penalty_trials = df.loc[df[penalty] == 1].nTrial.unique()
+def _get_fiber_entries(
+    key: dict, meta_info: dict, carrier_frequencies: list, demod_traces: list
+) -> tuple[list[dict], list[dict], dict]:
+    """Build the FiberPhotometry.Fiber and DemodulatedTrace rows and their lookup entries
 
-    if len(penalty_trials) > 1:
-        penalty_groups = df.loc[df.nTrial.isin(penalty_trials)].groupby(
-            "nTrial", as_index=False
+    carrier_frequencies and demod_traces are ordered as g_right, r_right, g_left, r_left
+    """
+    side_to_fiber_id_mapping = {"right": 1, "left": 2}
+    color_mapping = {"g": "green", "r": "red", "b": "blue"}
+    carrier_ind = {"g_right": 0, "r_right": 1, "g_left": 2, "r_left": 3}
+
+    implantation = meta_info.get("Fiber").get("implantation")
+    trace_indices = meta_info.get("Signal_Indices")
+
+    # float32 covers the ADC dynamic range and halves the stored blob size
+    demod_traces = [
+        np.ascontiguousarray(trace, dtype=np.float32) if trace is not None else None
+        for trace in demod_traces
+    ]
+
+    fiber_list: list[dict] = []
+    demodulated_trace_list: list[dict] = []
+    # Lookup entries collected across fibers, inserted once per table
+    lookup_rows: dict = {
+        EmissionColor: [],
+        SensorProtein: [],
+        ExcitationWavelength: [],
+        CarrierFrequency: [],
+    }
+
+    # Get photometry traces for each fiber
+    for fiber, fiber_id in side_to_fiber_id_mapping.items():
+        fiber_indices = trace_indices.get(fiber)
+        emission_wavelengths = fiber_indices.get("emission_wavelength", {})
+        sensor_proteins = fiber_indices.get("sensor_protein", {})
+        excitation_wavelengths = fiber_indices.get("excitation_wavelength", {})
+
+        fiber_list.append(
+            {
+                **key,
+                "fiber_id": fiber_id,
+                "hemisphere": fiber,
+                "notes": implantation.get(fiber).get("notes", None),
+            }
         )
 
-        mask = penalty_groups.apply(
-            lambda x: x[f"n{penalty[:-1]}"]
-            < behavior_df.loc[behavior_df.nTrial == x.nTrial.iloc[0].squeeze()][
-                f"n_{penalty[:-1]}"
-            ].squeeze()
+        for trace_name in ["photom_g", "photom_r", "carrier_g", "carrier_r"]:
+            if trace_name not in fiber_indices:
+                continue
+
+            trace_type, color = trace_name.split("_")
+            emission_color = color_mapping[color[0]]
+            sensor_protein = sensor_proteins.get(emission_color, None)
+            excitation_wavelength = excitation_wavelengths.get(emission_color, None)
+            channel = carrier_ind[f"{color}_{fiber}"]
+            carrier_frequency = carrier_frequencies[channel]
+
+            # Populate EmissionColor, and SensorProtein, ExcitationWavelength
+            # and CarrierFrequency if present
+            lookup_rows[EmissionColor].append(
+                {
+                    "emission_color": emission_color,
+                    "wavelength": emission_wavelengths.get(emission_color, None),
+                }
+            )
+            if sensor_protein:
+                lookup_rows[SensorProtein].append({"sensor_protein_name": sensor_protein})
+            if excitation_wavelength:
+                lookup_rows[ExcitationWavelength].append(
+                    {"excitation_wavelength": excitation_wavelength}
+                )
+            if carrier_frequency:
+                lookup_rows[CarrierFrequency].append(
+                    {"carrier_frequency": carrier_frequency}
+                )
+
+            demodulated_trace_list.append(
+                {
+                    **key,
+                    "fiber_id": fiber_id,
+                    "hemisphere": fiber,
+                    "trace_name": trace_type,
+                    "emission_color": emission_color,
+                    "sensor_protein_name": sensor_protein,
+                    "excitation_wavelength": excitation_wavelength,
+                    "carrier_frequency": carrier_frequency,
+                    "demod_sample_rate": carrier_frequency,
+                    "trace": demod_traces[channel],
+                }
+            )
+
+    return fiber_list, demodulated_trace_list, lookup_rows
+
+
+def _load_meta_info(meta_info_file: Path, required_keys: list[str]) -> dict:
+    """Load the meta_info.toml and check that the required (dotted) key paths exist
+
+    Missing sections are reported together, instead of surfacing later as
+    AttributeErrors on None or as NULLs in the inserted rows.
+    """
+    with open(meta_info_file, "rb") as f:
+        meta_info = tomli.load(f)
+
+    missing = []
+    for key_path in required_keys:
+        section = meta_info
+        for name in key_path.split("."):
+            if not isinstance(section, dict) or name not in section:
+                missing.append(key_path)
+                break
+            section = section[name]
+    if missing:
+        raise ValueError(
+            f"{meta_info_file} is missing required entries: {', '.join(missing)}"
         )
+    return meta_info
+
 
-    else:
-        mask = (
-            df.loc[df.nTrial.isin(penalty_trials), f"n{penalty[:-1]}"]
-            < behavior_df.loc[behavior_df.nTrial.isin(penalty_trials)][
-                f"n_{penalty[:-1]}"
-            ].squeeze()
+def _read_mat73_timeseries(
+    photometry_file: Path, freq_indices: list, data_indices: list
+) -> dict:
+    """Read the timeSeries struct array of a MATLAB v7.3 (HDF5) file
+
+    Only the time_offset of the first entry, the demux_freq of freq_indices and the
+    data of data_indices are read, keyed by entry index like pymatreader's output.
+    """
+    with h5py.File(photometry_file, "r") as h5:
+        time_series = h5["timeSeries"]
+
+        def read_field(field: str, idx: int):
+            # struct array fields hold one HDF5 object reference per entry
+            ref = time_series[field][()].ravel()[idx]
+            value = np.squeeze(h5[ref][()])
+            # scalars come back as Python numbers, like loadmat(squeeze_me=True)
+            return value.item() if value.ndim == 0 else value
+
+        return {
+            "time_offset": [read_field("time_offset", 0)],
+            "demux_freq": {
+                idx: read_field("demux_freq", idx)
+                for idx in freq_indices
+                if idx is not None
+            },
+            "data": {
+                idx: read_field("data", idx) for idx in data_indices if idx is not None
+            },
+        }
+
+
+def _insert_lookup_rows(lookup_rows: dict) -> None:
+    """Insert the lookup entries collected in FiberPhotometry.make, one query per table"""
+    for table, rows in lookup_rows.items():
+        # the same entry is collected once per trace, only send it once (numpy
+        # scalars and 0-d arrays are unhashable or compare by type, key on Python values)
+        rows = list(
+            {
+                tuple(
+                    (name, np.asarray(value).item() if np.ndim(value) == 0 else value)
+                    for name, value in row.items()
+                ): row
+                for row in rows
+            }.values()
         )
+        if rows:
+            logger.info(f"{len(rows)} entries are inserted into {__name__}.{table.__name__}")
+            table.insert(rows, skip_duplicates=True)
 
-    # Label pre-penalty states as penalties
-    df[f"state_{penalty}"] = 0
-    df.loc[df.nTrial.isin(penalty_trials), f"state_{penalty}"] = (
-        mask.values * df.loc[df.nTrial.isin(penalty_trials), f"{penalty[:-1]}"]
-    )
 
-    # Remove pre-penalty states from true states
-    df.loc[df.nTrial.isin(penalty_trials), f"{penalty[:-1]}"] = (
-        1 - mask.values
-    ) * df.loc[df.nTrial.isin(penalty_trials), f"{penalty[:-1]}"]
-        
-   
+def _parse_synced_trace_name(trace_name: str) -> dict:
+    """SyncedTrace attributes encoded in a trace name, e.g., "detrend_grnR"
 
+    Returns the fiber_id, hemisphere, trace_name and emission_color of the trace.
+    """
+    name, signal = trace_name.split("_")[:2]
+    side = trace_name[-1]
+    return {
+        "fiber_id": {"R": 1, "L": 2}[side],
+        "hemisphere": {"R": "right", "L": "left"}[side],
+        "trace_name": name,
+        "emission_color": {"g": "green", "r": "red"}.get(signal[0].lower()),
+    }
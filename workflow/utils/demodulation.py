@@ -4,14 +4,9 @@ Created on Fri Apr 15 16:01:51 2022
 @author: celiaberon and janetberrios
 """
 from __future__ import annotations
-import pandas as pd
-import numpy as np
-from copy import deepcopy
-from scipy import signal, stats, optimize
-import warnings
-import tdt
-
 import warnings
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 from scipy import stats
@@ -19,8 +14,14 @@ from scipy import signal
 from scipy import interpolate
 from scipy import optimize
 from scipy.signal.windows import hamming
+from scipy.fft import rfft, rfftfreq, next_fast_len
 from copy import deepcopy
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional, rolling_z falls back to pandas
+    njit, prange = None, range
+
 
 def gen_sine(x, timepoints=None):
 
@@ -34,6 +35,15 @@ def gen_cosine(x, timepoints=None):
     return tmp
 
 
+def fast_rfft(x, axis=-1):
+    """Real FFT zero-padded to the next fast length, threaded across all cores
+
+    Returns the spectrum and the padded length (for use with rfftfreq/irfft)
+    """
+    n = next_fast_len(np.shape(x)[axis], real=True)
+    return rfft(x, n=n, axis=axis, workers=-1), n
+
+
 def get_residuals(x, signal, **kwargs):
 
     return signal - gen_sine(x, **kwargs)
@@ -47,18 +57,31 @@ def is_filter_stable(coeffs):
     return np.all(np.abs(p) <= 1.0)
 
 
+@functools.lru_cache(maxsize=32)
+def ellip_sos(order, ripple, attenuation, Wn, btype, fs):
+    """Elliptic filter in second-order sections, cached since designs repeat across sessions"""
+    sos = signal.ellip(order, ripple, attenuation, Wn, btype=btype, fs=fs, output="sos")
+    return sos
+
+
+@functools.lru_cache(maxsize=32)
+def butter_sos(order, Wn, btype, fs):
+    """Butterworth filter in second-order sections, cached since designs repeat across sessions"""
+    sos = signal.butter(order, Wn, btype=btype, fs=fs, output="sos")
+    return sos
+
+
 def bandpass_signal(
-    x, center_fs, fs=6103.515625, order=4, bw=50, attenuation=40, ripple=0.1
+    x, center_fs, fs=6103.515625, order=4, bw=50, attenuation=40, ripple=0.1, axis=-1
 ):
 
-    sos = signal.ellip(
+    sos = ellip_sos(
         order,
         ripple,
         attenuation,
-        [center_fs - (bw // 2), center_fs + (bw // 2)],
-        btype="bandpass",
-        fs=fs,
-        output="sos",
+        (center_fs - (bw // 2), center_fs + (bw // 2)),
+        "bandpass",
+        fs,
     )
 
     if not is_filter_stable(sos):
@@ -66,9 +89,8 @@ def bandpass_signal(
             "Bandpass filter is unstable, change your design specifications"
         )
 
-    cleaned_signal = deepcopy(x)
-    cleaned_signal = signal.sosfiltfilt(sos, cleaned_signal)
-    return cleaned_signal
+    # sosfiltfilt returns a new array, x is left untouched
+    return signal.sosfiltfilt(sos, x, axis=axis)
 
 
 def get_baseline(x, win_samples, percentile=10):
@@ -80,20 +102,20 @@ def get_baseline(x, win_samples, percentile=10):
     )
 
 
-def downsample(x, fs, new_fs, method="polyphase"):
+def downsample(x, fs, new_fs, method="polyphase", axis=-1, window=("kaiser", 5.0)):
 
     x[np.isnan(x)] = 0
 
     if method.lower()[0] == "f":
-        total_secs = len(x) / fs
+        total_secs = x.shape[axis] / fs
         new_total = int(new_fs * total_secs)
-        new_signal = signal.resample(x, new_total)
+        new_signal = signal.resample(x, new_total, axis=axis)
     elif method.lower()[0] == "p":
         import fractions
 
         frac = fractions.Fraction(new_fs / fs).limit_denominator()
         p, q = frac.numerator, frac.denominator
-        new_signal = signal.resample_poly(x, p, q)
+        new_signal = signal.resample_poly(x, p, q, axis=axis, window=window)
     else:
         raise ValueError("Did not understand downsample method {}".format(method))
 
@@ -152,9 +174,9 @@ def detect_fs(x, tstep):
     OUTPUTS:
         maximum frequency band from FFT
     """
-    cmp_fft = np.fft.fft(x - np.mean(x))
+    cmp_fft, n = fast_rfft(x - np.mean(x))
     mx_fs = np.argmax(np.abs(cmp_fft))
-    hz = np.fft.fftfreq(x.size, tstep)
+    hz = rfftfreq(n, tstep)
     return np.abs(hz[mx_fs])
 
 
@@ -184,9 +206,9 @@ def fit_reference(
         ref = bandpass_signal(ref, center_fs=expected_fs, fs=fs, **bandpass_kwargs)
 
     ### fft on bp filtered signal to make sure matches input freq
-    cmp_fft = np.fft.fft(ref)
+    cmp_fft, n = fast_rfft(ref)
     mx_fs = np.argmax(np.abs(cmp_fft))
-    hz = np.fft.fftfreq(ref.size, tstep)
+    hz = rfftfreq(n, tstep)
     detected_fs = np.abs(hz[mx_fs])
 
     if np.abs(detected_fs - expected_fs) > 100:
@@ -228,25 +250,34 @@ def spec_demodulate(z1_trace_list, calc_carry_list, sampling_Hz, num_perseg, n_o
         demodulated_trace_list.append(demodulated_trace)
     return demodulated_trace_list
             
-def calc_carry(raw_carrier_list, sampling_Hz):
-                calc_carry_list = []
-                points_2_process = 2**14
-                for i in range(len(raw_carrier_list)):
-                    fft_carrier = abs(np.fft.fft(raw_carrier_list[i][0:points_2_process]))
-                    P2 = fft_carrier/points_2_process
-                    P1 = abs(P2/2+1)
-                    P1[1:-1] = 2*P1[1:-1]
-                    f = sampling_Hz * np.arange(points_2_process // 2) / points_2_process
-                    ind = np.argmax(P1, axis=None)
-                    processed_carrier = round(f[ind])
-                    calc_carry_list.append(processed_carrier)
-                return calc_carry_list
-
-def four(z1_trace_list):
-                four_list = []
-                for i in range(len(z1_trace_list)):
-                    four_list.append(np.fft.fft(z1_trace_list[i]))
-                return four_list 
+def stack_channels(trace_list, dtype=np.float32):
+    """Stack 1-D channel traces into a contiguous (n_channels, n_samples) array,
+    trimmed to the shortest trace"""
+    lengths = [len(trace) for trace in trace_list]
+    n_samples = min(lengths)
+    if max(lengths) != n_samples:
+        warnings.warn(
+            f"Channel lengths differ ({lengths}), trimming all channels to {n_samples} "
+            f"samples (dropping up to {max(lengths) - n_samples} samples per channel)."
+        )
+    return np.stack([np.asarray(trace)[:n_samples] for trace in trace_list]).astype(
+        dtype, copy=False
+    )
+
+
+def calc_carry(raw_carrier, sampling_Hz):
+    """Detect the carrier frequency of each channel (row) of raw_carrier"""
+    points_2_process = 2**14
+    carrier = np.stack([np.asarray(c)[:points_2_process] for c in raw_carrier])
+    # points_2_process is a power of two, so no padding is needed
+    fft_carrier = np.abs(rfft(carrier, axis=-1, workers=-1))
+    P2 = fft_carrier / points_2_process
+    P1 = np.abs(P2 / 2 + 1)
+    P1[:, 1:-1] = 2 * P1[:, 1:-1]
+    f = sampling_Hz * np.arange(points_2_process // 2 + 1) / points_2_process
+    ind = np.argmax(P1, axis=-1)
+    return [round(f[i]) for i in ind]
+
 
 def bandpass_demod(demodulated_trace_list, calc_carry_list, sampling_Hz, bp_bw):
     return [
@@ -258,39 +289,76 @@ def bandpass_demod(demodulated_trace_list, calc_carry_list, sampling_Hz, bp_bw):
             bw=bp_bw)
         for trace, calc_carry in zip(demodulated_trace_list, calc_carry_list)]
 
-def process_trace(raw_photom_list, calc_carry_list, sampling_Hz, window1, num_perseg, n_overlap):
-    z1_trace_list = []
-    power_spectra_list = []
-    t_list = []
-    spect_power_list = []
-    
-    for i in range(len(raw_photom_list)):
-        z_trace = rolling_z(raw_photom_list[i], window1)
-        z1_trace_list.append(z_trace)
-        
-        # Rolling demodulation
-        win = signal.hamming(num_perseg, 'periodic')
-        power_spectra = []
-        t = []
-        f, t_, Zxx = signal.spectrogram(z_trace, sampling_Hz, window=win, nperseg=num_perseg, noverlap=n_overlap)
-        power_spectra.append(np.abs(Zxx))
-        t.append(t_)
-        t = np.concatenate(t)
-        power_spectra = np.concatenate(power_spectra, axis=1)
-        freq_ind = np.argmin(np.abs(f - np.array(calc_carry_list[i]).reshape((-1, 1))), axis=1)
-        rolling_demod = power_spectra[freq_ind, :][0]
-        power_spectra_list.append(rolling_demod)
-        t_list.append(t)
-
-    #spect_power = np.mean(rolling_demod, axis=0)
-    spect_power_list.append(rolling_demod) #instead of spect power, no averaging needed
-    
-    power_spectra_list = np.array(power_spectra_list)
-    t_list = np.array(t_list)
-    spect_power_list = np.array(spect_power_list)
+def carrier_spectrogram(x, carrier_freqs, fs, window, nperseg, noverlap):
+    """Spectrogram power of each channel (row) of x at its carrier frequency only
+
+    Matches the carrier bin of scipy.signal.spectrogram (constant detrend, density
+    scaling, one-sided) but evaluates a single DFT bin per segment instead of the
+    full spectrum.
+    OUTPUTS:
+        power: (n_channels, n_segments) power at each channel's carrier bin
+        t: segment center times (in s)
+    """
+    x = np.atleast_2d(x)
+    step = nperseg - noverlap
+    segments = np.lib.stride_tricks.sliding_window_view(x, nperseg, axis=-1)[:, ::step, :]
+
+    f = rfftfreq(nperseg, 1 / fs)
+    freq_ind = np.argmin(np.abs(f - np.reshape(carrier_freqs, (-1, 1))), axis=1)
+    basis = window * np.exp(
+        -2j * np.pi * np.outer(freq_ind, np.arange(nperseg)) / nperseg
+    )  # windowed DFT kernel of each channel's carrier bin
+
+    spectrum = np.einsum("csn,cn->cs", segments, basis) - segments.mean(
+        axis=-1
+    ) * basis.sum(axis=-1, keepdims=True)
+    power = np.abs(spectrum) ** 2 / (fs * np.sum(window**2))
+
+    # one-sided spectrum: double every bin except DC and (even nperseg) Nyquist
+    is_nyquist = (nperseg % 2 == 0) & (freq_ind == nperseg // 2)
+    power[(freq_ind > 0) & ~is_nyquist] *= 2
+
+    t = np.arange(nperseg / 2, x.shape[-1] - nperseg / 2 + 1, step) / fs
+    return power, t
+
+
+def process_channel(trace, carrier_freq, sampling_Hz, window1, window, num_perseg, n_overlap):
+    """Rolling z-score and spectrogram demodulation of a single channel"""
+    z_trace = rolling_z(trace, window1).astype(trace.dtype, copy=False)
+    power, t = carrier_spectrogram(
+        z_trace, [carrier_freq], sampling_Hz, window, num_perseg, n_overlap
+    )
+    return z_trace, power[0], t
+
+
+def process_trace(raw_photom, calc_carry_list, sampling_Hz, window1, num_perseg, n_overlap):
+    """Rolling z-score and spectrogram demodulation of every channel (row) of raw_photom
+
+    Channels are processed in parallel threads: the rolling z-score (numba kernel
+    compiled with nogil, or pandas rolling windows without numba) and the numpy
+    kernels release the GIL, so no data has to be pickled to worker processes.
+    """
+    raw_photom = np.asarray(raw_photom)
+
+    # Rolling demodulation
+    win = hamming(num_perseg, 'periodic')
+
+    def process(i):
+        return process_channel(
+            raw_photom[i], calc_carry_list[i], sampling_Hz, window1, win, num_perseg, n_overlap
+        )
+
+    with ThreadPoolExecutor(max_workers=len(raw_photom)) as executor:
+        results = list(executor.map(process, range(len(raw_photom))))
+    z1_list, power_list, t_list = zip(*results)
+
+    z1_traces = np.stack(z1_list)
+    power_spectra_list = np.stack(power_list)
+    t_list = np.stack(t_list)
+    spect_power_list = power_spectra_list  # instead of spect power, no averaging needed
+
+    return z1_traces, power_spectra_list, t_list, spect_power_list
 
-    return z1_trace_list, power_spectra_list, t_list, spect_power_list
-             
 
 def demodulate(
     x,
@@ -319,7 +387,7 @@ def demodulate(
     demod_samples = int(demod_tau * downsample_fs)
 
     # get the product operators, then integrate and combine
-    sig = deepcopy(x)
+    sig = x
 
     if mod_bandpass:
         sig = bandpass_signal(
@@ -328,49 +396,39 @@ def demodulate(
 
     # get rms for x and y, downsample before r, multiply nyquist by .8 so we have headroom
 
-    mult_x = np.square(sig * ref_x)
-    mult_y = np.square(sig * ref_y)
+    # x and y products stacked as rows so each filter below runs once over both
+    mult = np.square(sig * np.stack([ref_x, ref_y]))
 
     if pre_downsample:
         if downsample_antialias:
-            sos = signal.butter(
-                downsample_filter_order,
-                0.8 * (downsample_fs / 2),
-                btype="low",
-                fs=fs,
-                output="sos",
-            )
-            if not is_filter_stable(sos):
-                raise ValueError(
-                    "Downsample filter unstable, change your filter specifications"
+            # the polyphase FIR already low-passes while resampling, so a separate
+            # antialias pass is only needed for FFT resampling
+            if downsample_method.lower()[0] != "p":
+                sos = butter_sos(
+                    downsample_filter_order, 0.8 * (downsample_fs / 2), "low", fs
                 )
-            mult_x = signal.sosfiltfilt(sos, mult_x)
-            mult_y = signal.sosfiltfilt(sos, mult_y)
-
-            mult_x = downsample(mult_x, fs, downsample_fs, method=downsample_method)
-            mult_y = downsample(mult_y, fs, downsample_fs, method=downsample_method)
+                if not is_filter_stable(sos):
+                    raise ValueError(
+                        "Downsample filter unstable, change your filter specifications"
+                    )
+                mult = signal.sosfiltfilt(sos, mult, axis=-1)
+
+            mult = downsample(
+                mult, fs, downsample_fs, method=downsample_method, window=("kaiser", 8.0)
+            )
 
     # final round of filtering
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", category=RuntimeWarning)
 
-        sos = signal.ellip(
-            demod_filter_order,
-            0.1,
-            40,
-            demod_fs,
-            btype="low",
-            fs=downsample_fs,
-            output="sos",
-        )
+        sos = ellip_sos(demod_filter_order, 0.1, 40, demod_fs, "low", downsample_fs)
 
         if not is_filter_stable(sos):
             raise ValueError(
                 "Integration filter is not stable, change your design specifications"
             )
 
-        int_x = np.sqrt(signal.sosfiltfilt(sos, mult_x))
-        int_y = np.sqrt(signal.sosfiltfilt(sos, mult_y))
+        int_x, int_y = np.sqrt(signal.sosfiltfilt(sos, mult, axis=-1))
         r = np.hypot(int_x, int_y)
 
     r[:demod_samples] = np.nan
@@ -383,16 +441,68 @@ def demodulate(
     return int_x, int_y, r, downsample_fs
 
 
-def rolling_z(x, wn):
-    x = pd.Series(x)
-    xbar = x.rolling(wn, center=True).mean()
-    xstd = x.rolling(wn, center=True).std()
+def _rolling_z_1d(x, wn):
+    """Centered rolling z-score with pandas' window alignment, NaN where incomplete
+
+    A running mean and sum of squared deviations (Welford update) are slid one
+    sample at a time, so the cost is O(N) regardless of the window length.
+    """
+    n = x.shape[0]
+    out = np.full(n, np.nan)
+    if wn < 2 or n < wn:
+        return out
+    # pandas centers an even window with (wn - 1) // 2 samples after the label
+    offset = (wn - 1) // 2
+
+    mean = 0.0
+    m2 = 0.0
+    for k in range(wn):
+        delta = x[k] - mean
+        mean += delta / (k + 1)
+        m2 += delta * (x[k] - mean)
+
+    for start in range(n - wn + 1):
+        if start > 0:
+            x_old = x[start - 1]
+            x_new = x[start + wn - 1]
+            new_mean = mean + (x_new - x_old) / wn
+            m2 += (x_new - x_old) * (x_new - new_mean + x_old - mean)
+            mean = new_mean
+        i = start + wn - 1 - offset
+        out[i] = (x[i] - mean) / np.sqrt(max(m2, 0.0) / (wn - 1))
+    return out
+
+
+def _rolling_z_2d(x, wn):
+    """_rolling_z_1d over each row of a 2-D array, rows scored in parallel"""
+    out = np.empty(x.shape)
+    for row in prange(x.shape[0]):
+        out[row] = _rolling_z_1d(x[row], wn)
+    return out
+
+
+if njit is not None:
+    # nogil so process_trace's channel threads can run the kernels concurrently
+    _rolling_z_1d = njit(cache=True, nogil=True)(_rolling_z_1d)
+    _rolling_z_2d = njit(cache=True, nogil=True, parallel=True)(_rolling_z_2d)
 
-    z = (x - xbar) / xstd
-    z[: wn // 2] = 0
-    z[-wn // 2 :] = 0
-    return z.values
 
+def rolling_z(x, wn):
+    """Centered rolling z-score; a 2-D input is scored along its last axis"""
+    x = np.asarray(x)
+    if njit is not None and x.ndim in (1, 2) and np.isfinite(x).all():
+        kernel = _rolling_z_1d if x.ndim == 1 else _rolling_z_2d
+        z = kernel(np.ascontiguousarray(x, dtype=np.float64), int(wn))
+    else:
+        frame = pd.DataFrame(x.T) if x.ndim == 2 else pd.Series(x)
+        rolling = frame.rolling(wn, center=True)
+        # an owned array, the edges are zeroed in place below
+        z = ((frame - rolling.mean()) / rolling.std()).to_numpy(copy=True)
+        z = z.T if x.ndim == 2 else z
+
+    z[..., : wn // 2] = 0
+    z[..., -wn // 2 :] = 0
+    return z
 
 
 def offline_demodulation(data, metadata, tau=20, z=True, z_window=60, downsample_fs=600, 
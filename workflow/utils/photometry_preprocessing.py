@@ -8,6 +8,9 @@ import pandas as pd
 import numpy as np
 import typing as T
 
+# numba is optional, its import is resolved once in demodulation (see downsample_bins)
+from workflow.utils.demodulation import njit, prange
+
 
 def set_analog_headers(analog_df: pd.DataFrame):
 
@@ -83,10 +86,18 @@ def bins_per_trial_photo(photo_df: pd.DataFrame):
 
 
 def resample_and_align(
-    beh_df, photo_df, channels=["grnR", "redR", "grnL", "redL"], by_trial=False
+    beh_df,
+    photo_df,
+    channels=["grnR", "redR", "grnL", "redL"],
+    by_trial=False,
+    session_clock: T.Optional[np.ndarray] = None,
 ) -> T.Tuple[pd.DataFrame, float]:
 
-    """resamples photometry data and aligns with behavior data"""
+    """resamples photometry data and aligns with behavior data
+
+    session_clock, if given, holds the behavior time (s) of each row of beh_df and is
+    only attached to the trimmed rows, otherwise beh_df needs a session_clock column
+    """
 
     import scipy.signal as sp_signal
 
@@ -149,11 +160,11 @@ def resample_and_align(
                 shorterList - np.max((0, offset))
             ]
         ]
-        behavior_session_trimmed = beh_df[
-            beh_bin_idx[np.max((0, offset))] : beh_bin_idx[
-                shorterList - np.max((0, -offset))
-            ]
-        ].reset_index(drop=True)
+        beh_start = beh_bin_idx[np.max((0, offset))]
+        beh_stop = beh_bin_idx[shorterList - np.max((0, -offset))]
+        behavior_session_trimmed = beh_df[beh_start:beh_stop].reset_index(drop=True)
+        if session_clock is not None:
+            behavior_session_trimmed["session_clock"] = session_clock[beh_start:beh_stop]
 
         # print(
         #     "downsampling by factor of ",
@@ -170,9 +181,10 @@ def resample_and_align(
         aligned_df = pd.concat(
             [behavior_session_trimmed, photo_resample], axis=1
         ).reset_index()
+        if session_clock is None:
+            session_clock = beh_df["session_clock"].to_numpy()
         time_offset = (
-            behavior_session_trimmed["session_clock"].iloc[0]
-            - beh_df["session_clock"].iloc[0]
+            behavior_session_trimmed["session_clock"].iloc[0] - session_clock[0]
         )  # in seconds
         # print(f"shift into behavior by {time_offset} seconds")
 
@@ -204,3 +216,119 @@ def zscore(x, window, rolling=False):
 
     z = (x - m) / s
     return z
+
+
+def _downsample_bins(state_mat, photo_mat, factor):
+    """Per bin of `factor` rows: max of each state column, mean of each photometry column
+
+    Both reductions skip NaNs (all-NaN bins give NaN) and share one pass over the rows,
+    the trailing partial bin included.
+    """
+    n_samples = state_mat.shape[0]
+    n_bins = (n_samples + factor - 1) // factor
+    state_out = np.full((n_bins, state_mat.shape[1]), np.nan)
+    photo_out = np.full((n_bins, photo_mat.shape[1]), np.nan)
+
+    for b in prange(n_bins):
+        start = b * factor
+        stop = min(start + factor, n_samples)
+        for c in range(state_mat.shape[1]):
+            best = np.nan
+            for i in range(start, stop):
+                value = state_mat[i, c]
+                if not np.isnan(value) and (np.isnan(best) or value > best):
+                    best = value
+            state_out[b, c] = best
+        for c in range(photo_mat.shape[1]):
+            total = 0.0
+            count = 0
+            for i in range(start, stop):
+                value = photo_mat[i, c]
+                if not np.isnan(value):
+                    total += value
+                    count += 1
+            if count:
+                photo_out[b, c] = total / count
+
+    return state_out, photo_out
+
+
+# Only worth calling compiled, None when numba is not installed
+downsample_bins = (
+    njit(cache=True, parallel=True)(_downsample_bins) if njit is not None else None
+)
+
+
+def downsample_task_states(
+    df: pd.DataFrame, factor: int, mean_columns: list[str]
+) -> pd.DataFrame:
+    """Reduce every `factor` consecutive rows to one, a trailing partial bin included
+
+    mean_columns are averaged and moved to the end, all other columns take the max.
+    """
+    n_samples = len(df)
+    n_full = (n_samples // factor) * factor
+    max_columns = [col for col in df.columns if col not in mean_columns]
+
+    if downsample_bins is not None:
+        # One fused (numba) pass over all rows, then back to the original dtypes
+        state_out, photo_out = downsample_bins(
+            df[max_columns].to_numpy(np.float64),
+            df[list(mean_columns)].to_numpy(np.float64),
+            factor,
+        )
+        downsampled = {
+            col: state_out[:, i].astype(df[col].dtype, copy=False)
+            for i, col in enumerate(max_columns)
+        }
+        for i, col in enumerate(mean_columns):
+            dtype = df[col].dtype if df[col].dtype.kind == "f" else np.float64
+            downsampled[col] = photo_out[:, i].astype(dtype, copy=False)
+        return pd.DataFrame(downsampled)
+
+    # Columns sharing a reduction and a dtype are reduced together as one 2-D block
+    blocks: dict = {}
+    for col in max_columns + list(mean_columns):
+        blocks.setdefault((col in mean_columns, df[col].dtype), []).append(col)
+
+    downsampled = {}
+    for (is_mean, dtype), cols in blocks.items():
+        if is_mean:
+            reduce = np.nanmean if dtype.kind == "f" else np.mean
+        else:
+            reduce = np.nanmax if dtype.kind == "f" else np.max
+        values = df[cols].to_numpy()
+        binned = reduce(values[:n_full].reshape(-1, factor, len(cols)), axis=1)
+        if n_full < n_samples:
+            binned = np.vstack([binned, reduce(values[n_full:], axis=0, keepdims=True)])
+        downsampled.update(zip(cols, binned.T))
+
+    return pd.DataFrame(
+        {col: downsampled[col] for col in max_columns + list(mean_columns)}
+    )
+
+
+def split_penalty_states(
+    df: pd.DataFrame, behavior_df: pd.DataFrame, penalties: tuple = ("ENLP", "CueP")
+    ) -> None:
+    """Handle penalties. Label preceding states as different from those without penalties"""
+    # Resolve the trial of every sample once, all per-trial values are then
+    # broadcast onto the samples by position
+    trials, trial_pos = np.unique(df["nTrial"].to_numpy(), return_inverse=True)
+    behavior_by_trial = behavior_df.set_index("nTrial").reindex(trials)
+
+    for penalty in penalties:
+        state = penalty[:-1]
+        base_state = df[state].to_numpy()
+        state_count = df[f"n{state}"].to_numpy()
+
+        # Trials with a penalty, and their penalty count from the behavior table
+        is_penalty_trial = np.zeros(len(trials), dtype=bool)
+        is_penalty_trial[trial_pos[df[penalty].to_numpy() == 1]] = True
+        threshold = behavior_by_trial[f"n_{state}"].to_numpy()
+
+        mask = is_penalty_trial[trial_pos] & (state_count < threshold[trial_pos])
+
+        # Label pre-penalty states as penalties, and remove them from true states
+        df[f"state_{penalty}"] = np.where(mask, base_state, 0)
+        df[state] = np.where(mask, 0, base_state)